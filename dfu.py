@@ -1,12 +1,17 @@
 import argparse
+import array
 import logging
+import mmap
 import sys
 import os
+import stat
+import struct
 import colorama
-import dataclasses
-from time import sleep
+import ctypes
+import functools
+from time import monotonic, sleep
 import timeit
-from typing import Any, List, Optional
+from typing import Any, BinaryIO, List, NamedTuple, Optional, Tuple
 import usb.core
 import usb.util
 from usb.backend import libusb1
@@ -19,9 +24,15 @@ _TIMEOUT_MS = 5000
 _DETACH_DELAY_S = 5
 _MAX_TRANSFER_SIZE = 4096
 
+# Windows timer resolution while polling DFU_GETSTATUS
+_TIMER_RESOLUTION_MS = 1
+
 # Default update size
 _DFU_UPDATE_SIZE = 1024*1024*32
 
+# Write buffer of the upload output file
+_UPLOAD_BUFFER_SIZE = 1024*1024
+
 # Default transfer size
 _DFU_TRANSFER_SIZE = 4096
 
@@ -44,6 +55,24 @@ _DFU_STATE_DFU_MANIFEST_WAIT_RST = 0x08
 _DFU_STATE_DFU_UPLOAD_IDLE = 0x09
 _DFU_STATE_DFU_ERROR = 0x0A
 
+# Give up on a device that has not become idle after this many seconds of
+# DFU_GETSTATUS polling. Chosen well above a full-chip erase or a slow
+# manifestation, a single bwPollTimeout can itself be up to ~16.7 s
+_DFU_POLL_TIMEOUT_S = 120
+
+# Minimum delay between DFU_GETSTATUS polls, doubled while the state
+# does not change, so bwPollTimeout = 0 does not spin on the bus. With
+# at least 1 ms between polls a reply can never be under 1 ms old when
+# the next poll is due, so no sleep(0) yield is needed on top of it
+_DFU_POLL_BACKOFF_MIN_MS = 1
+_DFU_POLL_BACKOFF_MAX_MS = 10
+
+# For devices whose bwPollTimeout underestimates the work, the first poll
+# of a block waits at least this share of the shorter of the last
+# _DFU_POLL_HISTORY block busy times of the same download
+_DFU_POLL_STRETCH_SCALE = 0.8
+_DFU_POLL_HISTORY = 2
+
 # DFU status
 _DFU_STATUS_OK               = 0x00
 _DFU_STATUS_ERR_TARGET       = 0x01
@@ -71,9 +100,23 @@ _DFU_CMD_CLRSTATUS = 4
 _DFU_CMD_GETSTATE  = 5
 _DFU_CMD_ABORT     = 6
 
+# bmRequestType of DFU class requests (recipient is the DFU interface)
+_BMREQ_CLASS_IFACE_IN = usb.util.build_request_type(
+  usb.util.CTRL_IN,
+  usb.util.CTRL_TYPE_CLASS,
+  usb.util.CTRL_RECIPIENT_INTERFACE
+)
+_BMREQ_CLASS_IFACE_OUT = usb.util.build_request_type(
+  usb.util.CTRL_OUT,
+  usb.util.CTRL_TYPE_CLASS,
+  usb.util.CTRL_RECIPIENT_INTERFACE
+)
+
 # DFU Des
 _DFU_DESCRIPTOR_LEN  = 9
 _DFU_DESC_FUNCTIONAL = 0x21
+# bLength, bDescriptorType, bmAttributes, wDetachTimeOut, wTransferSize, bcdDFUVersion
+_DFU_DESC_STRUCT = struct.Struct("<BBBHHH")
 
 # mode
 CMD_NONE = 0
@@ -88,97 +131,156 @@ _DFU_PROTOCOL_NONE = 0x00
 _DFU_PROTOCOL_RT  = 0x01
 _DFU_PROTOCOL_DFU = 0x02
 
+# Progress bar colors, colorama makes them work on older Windows consoles
+_ANSI_YELLOW = "\x1b[33m"
+_ANSI_RESET = "\x1b[0m"
+
 # DFU bmAttributes
 _DFU_CAN_DOWNLOAD    = (1 << 0)
 _DFU_CAN_UPLOAD      = (1 << 1)
 _DFU_MANIFEST_TOL    = (1 << 2)
 _DFU_WILL_DETACH     = (1 << 3)
 
-@dataclasses.dataclass
-class dfu_status:
+class dfu_status(NamedTuple):
   bStatus: int
   bwPollTimeout: int
   bState: int
 
-@dataclasses.dataclass
-class DfuDescriptor:
+# DFU_GETSTATUS reply: bStatus, bwPollTimeout (3 bytes), bState, iString
+_DFU_STATUS_STRUCT = struct.Struct("<B3sBB")
+# filled in place by every DFU_GETSTATUS, the fields are copied out at once
+_DFU_STATUS_BUF = array.array("B", bytes(_DFU_STATUS_STRUCT.size))
+
+class DfuDescriptor(NamedTuple):
   bmAttributes: int
   wDetachTimeOut: int
   wTransferSize: int
   bcdDFUVersion: int
 
 class ProgressBar:
-  bar_string_fmt = "\rProgress: [{}{}] {:.2%} {}/{}"
+  bar_string_fmt = "\rProgress: [{}{}] {:.2%} {}/{}    "
   cnt = 0
+  # redraw at most ~30 times per second, the final 100% is always drawn
+  redraw_interval = 1/30
   
   def __init__(self, total, bar_total=30):
     self.total = total
     self.bar_total = bar_total
+    self._last_draw = float("-inf")
+    self._inv_total = 1.0 / (total or 1)
+    # every possible bar, indexed by the number of filled cells
+    self._bar_chars = [("█" * i, " " * (bar_total - i)) for i in range(bar_total + 1)]
+    self._write = sys.stdout.write
+    self._flush = sys.stdout.flush
   
   def update(self, step=1, value=None):
-    total = self.total
-    if total == 0:
-      total = 1;
-
     if (value is None):
       self.cnt += step
     else:
       self.cnt = value
+
+    percent = self.cnt * self._inv_total
+    now = monotonic()
+    if percent < 1 and now - self._last_draw < self.redraw_interval:
+      return
+    self._last_draw = now
     
-    bar_cnt = (int((self.cnt/total)*self.bar_total))
-    space_cnt = self.bar_total - bar_cnt
+    bar_cnt = min(max(int(percent * self.bar_total), 0), self.bar_total)
+    bar, space = self._bar_chars[bar_cnt]
     
     progress = self.bar_string_fmt.format(
-      "█" * bar_cnt,
-      " " * space_cnt,
-      self.cnt/total,
+      bar,
+      space,
+      percent,
       self.cnt,
-      total
+      self.total or 1
     )
   
-    print(colorama.Style.NORMAL + colorama.Fore.YELLOW + progress, end="    ")
-    percent = self.cnt/total
-
     if percent >= 1:
-      print(colorama.Style.RESET_ALL + colorama.Fore.RESET + "\n")
+      progress += _ANSI_RESET + "\n\n"
+
+    # frames are already throttled, flush each one so it shows up
+    self._write(_ANSI_YELLOW + progress)
+    self._flush()
+
+def _parse_dfu_descriptor(extra: Any) -> Optional[DfuDescriptor]:
+  # pyusb does not seem to automatically parse DFU descriptors
+  if len(extra) != _DFU_DESCRIPTOR_LEN:
+    return None
+
+  # descriptor fields are little-endian
+  raw = bytes(extra)
+  logger.debug("DFU descriptor bytes: %s", raw.hex())
+  (bLength, bDescriptorType, bmAttributes,
+   wDetachTimeOut, wTransferSize, bcdDFUVersion) = _DFU_DESC_STRUCT.unpack(raw)
+  if (bLength != _DFU_DESCRIPTOR_LEN or bDescriptorType != _DFU_DESC_FUNCTIONAL):
+    return None
+
+  desc = DfuDescriptor(
+    bmAttributes=bmAttributes,
+    wDetachTimeOut=wDetachTimeOut,
+    wTransferSize=wTransferSize,
+    bcdDFUVersion=bcdDFUVersion,
+  )
+  logger.debug("DFU descriptor: %s", desc)
+  return desc
+
+def _scan_dfu_interfaces(
+  dev: usb.core.Device,
+) -> List[Tuple[usb.core.Interface, Optional[DfuDescriptor]]]:
+  """Walk the descriptors once, returning each DFU interface with its functional descriptor"""
+  return [
+    (intf, _parse_dfu_descriptor(intf.extra_descriptors))
+    for cfg in dev
+    for intf in cfg
+    if intf.bInterfaceClass == 0xFE and intf.bInterfaceSubClass == 1
+  ]
+
+def _first_dfu_descriptor(
+  dfu_interfaces: List[Tuple[usb.core.Interface, Optional[DfuDescriptor]]],
+) -> Optional[DfuDescriptor]:
+  return next((desc for _, desc in dfu_interfaces if desc is not None), None)
 
 def get_dfu_descriptor(dev: usb.core.Device) -> Optional[DfuDescriptor]:
-  for cfg in dev:
-    for intf in cfg:
-      # pyusb does not seem to automatically parse DFU descriptors
-      dfu_desc = intf.extra_descriptors
-      if (len(dfu_desc) == _DFU_DESCRIPTOR_LEN and dfu_desc[1] == _DFU_DESC_FUNCTIONAL):
-          desc = DfuDescriptor(
-            bmAttributes=dfu_desc[2],
-            wDetachTimeOut=dfu_desc[4] << 8 | dfu_desc[3],
-            wTransferSize=dfu_desc[6] << 8 | dfu_desc[5],
-            bcdDFUVersion=dfu_desc[8] << 8 | dfu_desc[7],
-          )
-          logger.debug("DFU descriptor: %s", desc)
-          return desc
-  return None
+  return _first_dfu_descriptor(_scan_dfu_interfaces(dev))
 
-def dfu_get_state(
-    dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
-) -> dfu_status:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_IN,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  status = dev.ctrl_transfer(
+def _dfu_ctrl(
+  dev: usb.core.Device,
+  interface: int,
+  request: int,
+  value: int,
+  data_or_wLength: Any,
+  direction: int,
+  timeout_ms: int = _TIMEOUT_MS,
+) -> Any:
+  """Issue one DFU class request to the DFU interface"""
+  if direction == usb.util.CTRL_IN:
+    bmRequestType = _BMREQ_CLASS_IFACE_IN
+  else :
+    bmRequestType = _BMREQ_CLASS_IFACE_OUT
+
+  return dev.ctrl_transfer(
     bmRequestType=bmRequestType,
-    bRequest=_DFU_CMD_GETSTATUS,
-    wValue=0,
+    bRequest=request,
+    wValue=value,
     wIndex=interface,
-    data_or_wLength=6,
+    data_or_wLength=data_or_wLength,
     timeout=timeout_ms,
   )
+
+def dfu_get_state(
+    dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
+) -> dfu_status:
+  length = _dfu_ctrl(dev, interface, _DFU_CMD_GETSTATUS, 0, _DFU_STATUS_BUF, usb.util.CTRL_IN, timeout_ms)
+  if length != _DFU_STATUS_STRUCT.size:
+    raise ValueError(f"short DFU_GETSTATUS reply: {length} bytes")
   
+  # bwPollTimeout is a 3 byte little-endian field
+  bStatus, bwPollTimeout, bState, _ = _DFU_STATUS_STRUCT.unpack(_DFU_STATUS_BUF)
   status = dfu_status(
-    bStatus=status[0],
-    bwPollTimeout=((0xff & status[3]) << 16) |((0xff & status[2]) << 8)  | (0xff & status[1]),
-    bState=status[4]
+    bStatus=bStatus,
+    bwPollTimeout=int.from_bytes(bwPollTimeout, "little"),
+    bState=bState
   )
   
   return status
@@ -186,92 +288,87 @@ def dfu_get_state(
 def dfu_clear_status(
   dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
 ) -> Any:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_OUT,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  ret = dev.ctrl_transfer(
-      bmRequestType=bmRequestType,
-      bRequest=_DFU_CMD_CLRSTATUS,
-      wValue=0,
-      wIndex=interface,
-      data_or_wLength=None,
-      timeout=timeout_ms,
-  )
-
-  return ret
+  return _dfu_ctrl(dev, interface, _DFU_CMD_CLRSTATUS, 0, None, usb.util.CTRL_OUT, timeout_ms)
 
 def dfu_abort_status(
   dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
 ) -> Any:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_OUT,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  ret = dev.ctrl_transfer(
-      bmRequestType=bmRequestType,
-      bRequest=_DFU_CMD_ABORT,
-      wValue=0,
-      wIndex=interface,
-      data_or_wLength=None,
-      timeout=timeout_ms,
-  )
-  
-  return ret
+  return _dfu_ctrl(dev, interface, _DFU_CMD_ABORT, 0, None, usb.util.CTRL_OUT, timeout_ms)
 
 def dfu_detch(
   dev: usb.core.Device, interface: int, timeout_ms: int = _TIMEOUT_MS
 ) -> Any:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_OUT,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  ret = dev.ctrl_transfer(
-      bmRequestType=bmRequestType,
-      bRequest=_DFU_CMD_DETACH,
-      wValue=0,
-      wIndex=interface,
-      data_or_wLength=None,
-      timeout=timeout_ms,
-  )
-  
-  return ret
+  return _dfu_ctrl(dev, interface, _DFU_CMD_DETACH, 0, None, usb.util.CTRL_OUT, timeout_ms)
 
-def dfu_download(
+def _wait_dfu_idle(
   dev: usb.core.Device,
   interface: int,
-  transaction: int,
-  data: Optional[bytes],
+  allowed_idles: Tuple[int, ...],
   timeout_ms: int = _TIMEOUT_MS,
-) -> None:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_OUT,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  dev.ctrl_transfer(
-      bmRequestType=bmRequestType,
-      bRequest=_DFU_CMD_DOWNLOAD,
-      wValue=transaction,
-      wIndex=interface,
-      data_or_wLength=data,
-      timeout=timeout_ms,
-  )
-  
-  while (True):
+  busy_history: Optional[List[float]] = None,
+) -> dfu_status:
+  last_state = None
+  backoff_ms = _DFU_POLL_BACKOFF_MIN_MS
+  busy_since = None
+  stretched = False
+  polls = 0
+  deadline = monotonic() + _DFU_POLL_TIMEOUT_S
+
+  while True:
     status = dfu_get_state(dev, interface, timeout_ms=timeout_ms)
-    #print(status.bState)
-  
-    if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_IDLE):
-      break
+    polls += 1
+
+    if status.bState in allowed_idles:
+      if busy_history is not None:
+        if stretched and polls == 2:
+          # idle at the first poll after a stretched sleep, so how long the
+          # device really needed is unknown: measure the next block again
+          busy_history.clear()
+        else :
+          busy_history.append(0.0 if busy_since is None else monotonic() - busy_since)
+          del busy_history[:-_DFU_POLL_HISTORY]
+      return status
     elif (status.bStatus != _DFU_STATUS_OK or status.bState == _DFU_STATE_DFU_ERROR):
       dfu_clear_status(dev, interface, timeout_ms=timeout_ms)
       raise RuntimeError(f"status is not OK: {status.bState} {status.bStatus}")
+
+    if monotonic() >= deadline:
+      raise TimeoutError(
+        f"device did not become idle within {_DFU_POLL_TIMEOUT_S} s, state {status.bState}"
+      )
+
+    if status.bState != last_state:
+      last_state = status.bState
+      backoff_ms = _DFU_POLL_BACKOFF_MIN_MS
     else :
-      sleep(status.bwPollTimeout/1000)
+      backoff_ms = min(backoff_ms * 2, _DFU_POLL_BACKOFF_MAX_MS)
+
+    delay_ms = max(status.bwPollTimeout, backoff_ms)
+    if busy_since is None:
+      busy_since = monotonic()
+      # never poll earlier than bwPollTimeout, but skip the polls recent
+      # blocks have shown to be too early. The shorter of the samples keeps
+      # a single slow block (an erase) from stretching the ones after it
+      if busy_history is not None and len(busy_history) == _DFU_POLL_HISTORY:
+        stretch_ms = _DFU_POLL_STRETCH_SCALE * 1000 * min(busy_history)
+        if stretch_ms > delay_ms:
+          delay_ms = stretch_ms
+          stretched = True
+
+    sleep(delay_ms/1000)
+
+def dfu_download(
+  dev: usb.core.Device,
+  interface: int,
+  transaction: int,
+  data: Optional[bytes],
+  timeout_ms: int = _TIMEOUT_MS,
+  allowed_idles: Tuple[int, ...] = (_DFU_STATE_DFU_DOWNLOAD_IDLE, _DFU_STATE_DFU_IDLE),
+  busy_history: Optional[List[float]] = None,
+) -> None:
+  _dfu_ctrl(dev, interface, _DFU_CMD_DOWNLOAD, transaction, data, usb.util.CTRL_OUT, timeout_ms)
+  
+  _wait_dfu_idle(dev, interface, allowed_idles, timeout_ms=timeout_ms, busy_history=busy_history)
 
 def dfu_upload(
   dev: usb.core.Device,
@@ -280,119 +377,172 @@ def dfu_upload(
   xfersize: int,
   timeout_ms: int = _TIMEOUT_MS,
 ) -> bytes:
-  bmRequestType = usb.util.build_request_type(
-                  usb.util.CTRL_IN,
-                  usb.util.CTRL_TYPE_CLASS,
-                  usb.util.CTRL_RECIPIENT_INTERFACE
-  )
-  data = dev.ctrl_transfer(
-      bmRequestType=bmRequestType,
-      bRequest=_DFU_CMD_UPLOAD,
-      wValue=transaction,
-      wIndex=interface,
-      data_or_wLength=xfersize,
-      timeout=timeout_ms,
-  )
+  rxbuf = array.array("B", bytes(xfersize))
+  length = dfu_upload_into(dev, interface, transaction, rxbuf, timeout_ms=timeout_ms)
+  return rxbuf[:length].tobytes()
 
-  while (True):
-    status = dfu_get_state(dev, interface, timeout_ms=timeout_ms)
-    #print(status.bState)
-  
-    if (status.bState == _DFU_STATE_DFU_UPLOAD_IDLE or status.bState == _DFU_STATE_DFU_IDLE):
-      break
-    elif (status.bStatus != _DFU_STATUS_OK or status.bState == _DFU_STATE_DFU_ERROR):
-      dfu_clear_status(dev, interface, timeout_ms=timeout_ms)
-      raise RuntimeError(f"status is not OK: {status.bState} {status.bStatus}")
-    else :
-      sleep(status.bwPollTimeout/1000)
+def dfu_upload_into(
+  dev: usb.core.Device,
+  interface: int,
+  transaction: int,
+  rxbuf: array.array,
+  timeout_ms: int = _TIMEOUT_MS,
+) -> int:
+  # pyusb reads straight into an array('B') and returns the length
+  length = _dfu_ctrl(dev, interface, _DFU_CMD_UPLOAD, transaction, rxbuf, usb.util.CTRL_IN, timeout_ms)
+
+  _wait_dfu_idle(
+    dev,
+    interface,
+    (_DFU_STATE_DFU_UPLOAD_IDLE, _DFU_STATE_DFU_IDLE),
+    timeout_ms=timeout_ms,
+  )
 
-  return data
+  return length
 
 def dfu_claim_interface(dev: usb.core.Device, interface: int, alt: int) -> None:
   print(f"Claiming USB DFU interface: {interface}")
   usb.util.claim_interface(dev, interface)
+  dev.set_interface_altsetting(interface, alt)
 
 def dfu_release_interface(dev: usb.core.Device) -> None:
   print(f"Releasing USB DFU interface")
   usb.util.dispose_resources(dev)
 
+def _get_backend() -> Any:
+  # prefer the libusb-1.0.dll shipped next to dfu.py on Windows, by
+  # absolute path: since Python 3.8 ctypes does not search the current
+  # directory for a bare DLL name. None lets pyusb pick its default backend
+  localpath_libusb1_win32 = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "libusb-1.0.dll"
+  )
+  if sys.platform == 'win32' and os.path.exists(localpath_libusb1_win32):
+    back = libusb1.get_backend(find_library=lambda x:localpath_libusb1_win32)
+    if back is None:
+      logger.warning("Could not load %s, using the default backend", localpath_libusb1_win32)
+    return back
+  return None
+
+_BACKEND = _get_backend()
+
+def _timer_resolution_begin() -> None:
+  # Windows sleeps in ~15 ms ticks by default, much longer than the
+  # bwPollTimeout most devices report between DFU_GETSTATUS polls
+  if sys.platform == 'win32':
+    ctypes.windll.winmm.timeBeginPeriod(_TIMER_RESOLUTION_MS)
+
+def _timer_resolution_end() -> None:
+  if sys.platform == 'win32':
+    ctypes.windll.winmm.timeEndPeriod(_TIMER_RESOLUTION_MS)
+
+def _is_dfu_device(device: usb.core.Device) -> bool:
+  """Identify DFU devices"""
+  return any(
+    intf.bInterfaceClass == 0xFE and intf.bInterfaceSubClass == 1
+    for cfg in device
+    for intf in cfg
+  )
+
 def _get_dfu_devices(
   vid: Optional[int] = None, pid: Optional[int] = None
 ) -> List[usb.core.Device]:
-  class FilterDFU:  # pylint: disable=too-few-public-methods
-    """Identify DFU devices"""
-    def __call__(self, device: usb.core.Device) -> bool:
-      if vid is None or vid == device.idVendor:
-        if pid is None or pid == device.idProduct:
-          for cfg in device:
-            for intf in cfg:
-              if (intf.bInterfaceClass == 0xFE and intf.bInterfaceSubClass == 1):
-                return True
-      return False
-  
-  localpath_libusb1_win32 = os.path.dirname(sys.argv[0]) + "\libusb-1.0.dll"
-  if sys.platform == 'win32' and os.path.exists(localpath_libusb1_win32):
-    back = libusb1.get_backend(find_library=lambda x:localpath_libusb1_win32)
-    return list(usb.core.find(find_all=True, backend=back, custom_match=FilterDFU()))
-  else :
-    return list(usb.core.find(find_all=True, custom_match=FilterDFU()))
+  # vid/pid are matched by usb.core.find() against the device descriptor
+  # before _is_dfu_device has to walk the configuration descriptors
+  match = {}
+  if vid is not None:
+    match["idVendor"] = vid
+  if pid is not None:
+    match["idProduct"] = pid
+
+  return list(usb.core.find(find_all=True, backend=_BACKEND, custom_match=_is_dfu_device, **match))
 
 def _dfu_download(
-  dev: usb.core.Device, interface: int, data: bytes, xfersize: int
+  dev: usb.core.Device,
+  interface: int,
+  data: bytes,
+  xfersize: int,
+  attributes: int = _DFU_MANIFEST_TOL,
 ) -> None:
   transaction = 0
-  bytes_downloaded = 0
-  _totol = len(data)
-  progressbar = ProgressBar(total=_totol, bar_total=30)
+  total = len(data)
+  progressbar = ProgressBar(total=total, bar_total=30)
+  # bound once to this device, the loop below runs once per block
+  send = functools.partial(dfu_download, dev, interface)
+  update_progress = progressbar.update
+  # busy times of the latest blocks, only ever about this download
+  busy_history: List[float] = []
 
   try:
-    while bytes_downloaded < len(data):
-        chunk_size = min(xfersize, len(data) - bytes_downloaded)
-        chunk = data[bytes_downloaded : bytes_downloaded + chunk_size]
-  
-        logger.debug(
-            "Downloading %d bytes (total: %d bytes)",
-            chunk_size,
-            bytes_downloaded,
-        )
+    # DFU_DNLOAD is only accepted in dfuIDLE/dfuDNLOAD-IDLE, and the device
+    # stays in dfuDNLOAD-SYNC until it is polled with DFU_GETSTATUS, so every
+    # block has to be acknowledged before the next one is sent
+    for offset in range(0, total, xfersize):
+        end = offset + xfersize
+        if end > total:
+          end = total
+        # keep this a bytes slice: pyusb copies bytes into its transfer
+        # buffer with one memcpy but walks a memoryview element by element
+        chunk = data[offset : end]
   
-        dfu_download(dev, interface, transaction, chunk)
-        progressbar.update(value=bytes_downloaded)
+        send(transaction, chunk, busy_history=busy_history)
+        update_progress(value=offset)
         transaction += 1
-        bytes_downloaded += chunk_size
 
-    # send one zero sized download request to signalize end
-    dfu_download(dev, interface, transaction, None)
-    progressbar.update(value=progressbar.total)
+    # send one zero sized download request to signalize end. A manifestation
+    # tolerant device comes back to dfuIDLE (some report dfuDNLOAD-IDLE),
+    # any other is polled through dfuMANIFEST, honouring bwPollTimeout and
+    # seeing any manifestation error, until it waits in
+    # dfuMANIFEST-WAIT-RESET
+    if attributes & _DFU_MANIFEST_TOL:
+      manifested = (_DFU_STATE_DFU_DOWNLOAD_IDLE, _DFU_STATE_DFU_IDLE)
+    else :
+      manifested = (_DFU_STATE_DFU_MANIFEST_WAIT_RST, _DFU_STATE_DFU_IDLE)
+
+    try:
+      send(transaction, None, allowed_idles=manifested)
+    except usb.core.USBError as err:
+      # with bitWillDetach a device that is not manifestation tolerant
+      # does the bus detach-attach itself instead of waiting for a reset
+      if (attributes & _DFU_MANIFEST_TOL or not attributes & _DFU_WILL_DETACH):
+        raise
+      logger.info("Device detached after manifestation: %s", err)
+    update_progress(value=total)
   except usb.core.USBError as err:
     logger.warning("Ignoring USB error when exiting DFU: %s", err)
 
 def _dfu_upload(
-  dev: usb.core.Device, interface: int, transferSize: int
-) -> bytes:
+  dev: usb.core.Device,
+  interface: int,
+  transferSize: int,
+  fout: BinaryIO,
+  upload_size: int = _DFU_UPDATE_SIZE,
+) -> int:
   transaction = 0
   bytes_uploaded = 0
-  _totol = int(args.upload_size)
+  _totol = int(upload_size)
 
   if _totol <= 0:
     _totol = _DFU_UPDATE_SIZE
 
   progressbar = ProgressBar(total=_totol, bar_total=30)
-  data = bytes()
+  # one receive buffer for the whole upload
+  rxbuf = array.array("B", bytes(transferSize))
+  rxview = memoryview(rxbuf)
+  receive = functools.partial(dfu_upload_into, dev, interface)
 
   try:
     while True:
-      rdata = dfu_upload(dev, interface, transaction, transferSize)
+      length = receive(transaction, rxbuf)
       if bytes_uploaded < progressbar.total:
         progressbar.update(value=bytes_uploaded)
       else :
         progressbar.update(value=progressbar.total-1)
   
-      data += rdata
-      bytes_uploaded += len(rdata)
+      fout.write(rxview[:length])
+      bytes_uploaded += length
       transaction += 1
   
-      if len(rdata) < transferSize :
+      if length < transferSize :
         break
   
     progressbar = ProgressBar(total=bytes_uploaded)
@@ -400,7 +550,7 @@ def _dfu_upload(
   except usb.core.USBError as err:
     logger.warning("Ignoring USB error when exiting DFU: %s", err)
   
-  return data
+  return bytes_uploaded
 
 def list_devices(vid: Optional[int] = None, pid: Optional[int] = None) -> None:
   devicelist = _get_dfu_devices(vid=vid, pid=pid)
@@ -411,56 +561,74 @@ def list_devices(vid: Optional[int] = None, pid: Optional[int] = None) -> None:
     for device in devicelist:
         print("DFU devices: Bus {} Device {:03d}: ID {:04x}:{:04x}".format(device.bus, device.address, device.idVendor, device.idProduct))
 
+def _ensure_dfu_idle(dev: usb.core.Device, interface: int) -> int:
+  # one DFU_GETSTATUS on the happy path, re-probe only after CLRSTATUS/ABORT
+  status = dfu_get_state(dev, interface)
+  if (status.bState == _DFU_STATE_APP_IDLE or status.bState == _DFU_STATE_APP_DETACH):
+    print(f"Device still run in Run-Time Mode, status.bState = {status.bState}")
+    return 1
+
+  if (status.bStatus != _DFU_STATUS_OK or status.bState == _DFU_STATE_DFU_ERROR):
+    print("error clear status")
+    print(f"send DFU_CLRSTATUS")
+    ret = dfu_clear_status(dev, interface)
+    if ret < 0:
+      return 1
+    status = dfu_get_state(dev, interface)
+
+  if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
+    print("aborting previous incomplete transfer")
+    print(f"send DFU_ABORT")
+    ret = dfu_abort_status(dev, interface)
+    if ret < 0:
+      print(f"can't send DFU_ABORT")
+      return 1
+
+    status = dfu_get_state(dev, interface)
+    if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
+      print(f"abort is not OK")
+      return 1
+    else :
+      print(f"abort is OK")
+
+  return 0
+
 def download(
   dev: usb.core.Device,
   filename: str,
   interface: int = 0,
   transferSize: int = 0,
+  attributes: int = _DFU_MANIFEST_TOL,
 ) -> int:
   print(f"Downloading binary file: {filename}")
 
-  if not os.path.exists(filename) :
-    print(f"not exists: {filename}")
-    return 1
-  
-  if not os.access(filename, os.R_OK) :
-    print(f"not readable: {filename}")
+  try:
+    fin = open(filename, "rb")
+  except OSError as err:
+    print(f"cannot open {filename}: {err.strerror}")
     return 1
   
-  fin = open(filename, "rb")
-  
   try:
-    status = dfu_get_state(dev, interface)
-    if (status.bState == _DFU_STATE_APP_IDLE or status.bState == _DFU_STATE_APP_DETACH):
-      print(f"Device still run in Run-Time Mode, status.bState = {status.bState}")
+    if _ensure_dfu_idle(dev, interface) != 0:
       return 1
-      
-    status = dfu_get_state(dev, interface)
-    if (status.bStatus != _DFU_STATUS_OK or status.bState == _DFU_STATE_DFU_ERROR):
-      print("error clear status")
-      print(f"send DFU_CLRSTATUS")
-      ret = dfu_clear_status(dev, interface)
-      if ret < 0:
-        return 1
-    
-    status = dfu_get_state(dev, interface)
-    if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
-      print("aborting previous incomplete transfer")
-      print(f"send DFU_ABORT")
-      ret = dfu_abort_status(dev, interface)
-      if ret < 0:
-        print(f"can't send DFU_ABORT")
-        return 1
-    
-      status = dfu_get_state(dev, interface)
-      if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
-        print(f"abort is not OK")
-        return 1
-      else :
-        print(f"abort is OK")
-    
-    data = fin.read()
-    _dfu_download(dev, interface, data, transferSize)
+
+    # map the file instead of reading it, the page cache is the only copy.
+    # FIFOs, /dev/stdin and <(...) report st_size 0 whatever they carry,
+    # so only regular files are mapped
+    mapped = None
+    if stat.S_ISREG(os.fstat(fin.fileno()).st_mode):
+      try:
+        mapped = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+      except (OSError, ValueError):
+        # empty file, or a file system that cannot map it
+        mapped = None
+
+    if mapped is None:
+      # read to EOF, not to the size fstat reported
+      _dfu_download(dev, interface, fin.read(), transferSize, attributes)
+    else:
+      with mapped:
+        _dfu_download(dev, interface, mapped, transferSize, attributes)
   finally:
     fin.close()
   
@@ -471,55 +639,32 @@ def upload(
   filename: str,
   interface: int = 0,
   transferSize: int = 0,
+  upload_size: int = _DFU_UPDATE_SIZE,
 ) -> int:
   print(f"Uploading binary file: {filename}")
-  fout = open(filename, "wb")
-  
-  if not os.access(filename, os.W_OK) :
-     print(f"not writable: {filename}")
-     return 1
-  
-  try:
-    status = dfu_get_state(dev, interface)
-    if (status.bState == _DFU_STATE_APP_IDLE or status.bState == _DFU_STATE_APP_DETACH):
-      print(f"Device still run in Run-Time Mode, status.bState = {status.bState}")
-      return 1
+  if _ensure_dfu_idle(dev, interface) != 0:
+    return 1
 
-    status = dfu_get_state(dev, interface)
-    if (status.bStatus != _DFU_STATUS_OK or status.bState == _DFU_STATE_DFU_ERROR):
-      print("error clear status")
-      print(f"send DFU_CLRSTATUS")
-      ret = dfu_clear_status(dev, interface)
-      if ret < 0:
-        return 1
+  # create/truncate the output only once the device is ready
+  try:
+    fd = os.open(
+      filename,
+      os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+      0o666,  # same as open(..., "wb"), the umask decides
+    )
+  except OSError as err:
+    print(f"cannot open {filename}: {err.strerror}")
+    return 1
 
-    status = dfu_get_state(dev, interface)
-    if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
-      print("aborting previous incomplete transfer")
-      print(f"send DFU_ABORT")
-      ret = dfu_abort_status(dev, interface)
-      if ret < 0:
-        print(f"can't send DFU_ABORT")
-        return 1
-    
-      status = dfu_get_state(dev, interface)
-      if (status.bState == _DFU_STATE_DFU_DOWNLOAD_IDLE or status.bState == _DFU_STATE_DFU_UPLOAD_IDLE):
-        print(f"abort is not OK")
-        return 1
-      else :
-        print(f"abort is OK")
-    
-    data = _dfu_upload(dev, interface, transferSize)
-    if len(data) > 0:
-      fout.write(data)
-  finally:
-    fout.close()
+  with os.fdopen(fd, "wb", buffering=_UPLOAD_BUFFER_SIZE) as fout:
+    _dfu_upload(dev, interface, transferSize, fout, upload_size)
   
   return 0
 
 def detch(
   dev: usb.core.Device,
   interface: int = 0,
+  detach_delay: int = _DETACH_DELAY_S,
 ) -> int:
   try:
     ret = dfu_detch(dev, interface)
@@ -529,29 +674,30 @@ def detch(
       return 1
     else :
       print(f"send DFU_DETACH")
-      print(f"delay {args.detach_delay} sec")
-      sleep(args.detach_delay)
+      print(f"delay {detach_delay} sec")
+      sleep(detach_delay)
   finally:
     return 0
 
 def get_dfu_device(
-  vid: Optional[int] = None, pid: Optional[int] = None
+  args: argparse.Namespace, vid: Optional[int] = None, pid: Optional[int] = None
 ):
   transfer_size = _DFU_TRANSFER_SIZE
   interface = _DFU_INTERFACE
   dfu_mode = 0
+  bmAttributes = 0
   altsetting = args.match_iface_alt_index
   dev = None
   devices = _get_dfu_devices(vid=vid, pid=pid)
   
   if not devices:
     print("No DFU devices found")
-    return dev, dfu_mode, interface, altsetting, transfer_size
+    return dev, dfu_mode, bmAttributes, interface, altsetting, transfer_size
 
   if len(devices) > 1:
     print(f"Too many DFU devices ({len(devices)}). List devices for "
            "more info and specify vid:pid to filter.")
-    return dev, dfu_mode, interface, altsetting, transfer_size
+    return dev, dfu_mode, bmAttributes, interface, altsetting, transfer_size
 
   dev = devices[0]
 
@@ -561,68 +707,59 @@ def get_dfu_device(
     except usb.core.USBError as e:
       raise ValueError("Could not set configuration: %s" % str(e))
   
-  dfu_desc = get_dfu_descriptor(dev)
+  dfu_interfaces = _scan_dfu_interfaces(dev)
+  dfu_desc = _first_dfu_descriptor(dfu_interfaces)
 
   if dfu_desc is None:
     raise ValueError("No DFU Functional descriptor, is this a valid DFU device?")
 
-  bitWillDetach = False
-  
-  if (dfu_desc.bmAttributes & _DFU_WILL_DETACH):
-      bitWillDetach = True
-
-  if args.verbose:
-    print(f"DFU Functional descriptor:")
-    print(f" bcdDFUVersion = 0x{dfu_desc.bcdDFUVersion:04X}")
-    print(f" wDetachTimeOut = 0x{dfu_desc.wDetachTimeOut}")
-    print(f" wTransferSize = 0x{dfu_desc.wTransferSize}")
-    print(f" bmAttributes = 0x{dfu_desc.bmAttributes}")
-  
-    if (dfu_desc.bmAttributes & _DFU_CAN_DOWNLOAD):
-      print(f"  bitCanDnload = 1")
-    else :
-      print(f"  bitCanDnload = 0")
-
-    if (dfu_desc.bmAttributes & _DFU_CAN_UPLOAD):
-      print(f"  bitCanUpload = 1")
-    else :
-      print(f"  bitCanUpload = 0")
-
-    if (dfu_desc.bmAttributes & _DFU_MANIFEST_TOL):
-      print(f"  bitManifestationTolerant = 1")
-    else :
-      print(f"  bitManifestationTolerant = 0")
-
-    if (dfu_desc.bmAttributes & _DFU_WILL_DETACH):
-      print(f"  bitWillDetach = 1")
-    else :
-      print(f"  bitWillDetach = 0")
+  bmAttributes = dfu_desc.bmAttributes
+  logger.debug("DFU Functional descriptor:")
+  logger.debug(" bcdDFUVersion = 0x%04X", dfu_desc.bcdDFUVersion)
+  logger.debug(" wDetachTimeOut = %d", dfu_desc.wDetachTimeOut)
+  logger.debug(" wTransferSize = %d", dfu_desc.wTransferSize)
+  logger.debug(" bmAttributes = 0x%02X", bmAttributes)
+  logger.debug("  bitCanDnload = %d", bool(bmAttributes & _DFU_CAN_DOWNLOAD))
+  logger.debug("  bitCanUpload = %d", bool(bmAttributes & _DFU_CAN_UPLOAD))
+  logger.debug("  bitManifestationTolerant = %d", bool(bmAttributes & _DFU_MANIFEST_TOL))
+  logger.debug("  bitWillDetach = %d", bool(bmAttributes & _DFU_WILL_DETACH))
 
   #if dfu_desc.bcdDFUVersion != 0x0101 :
   #  raise ValueError("bcdDFUVersion != 0x0101")
 
-  transfer_size = dfu_desc.wTransferSize
+  # keep the default when the descriptor reports no transfer size,
+  # zero sized blocks would never finish a download
+  # use the largest block the device accepts, capped to what main() allows
+  if dfu_desc.wTransferSize:
+    transfer_size = min(dfu_desc.wTransferSize, _MAX_TRANSFER_SIZE)
 
   if args.transfer_size:
     transfer_size = args.transfer_size
 
-  for cfg in dev:
-    for intf in cfg:
-      if (intf.bInterfaceClass == 0xFE and intf.bInterfaceSubClass == 1):
-        interface = intf.bInterfaceNumber
-        if (intf.bInterfaceProtocol == _DFU_PROTOCOL_DFU):
-          dfu_mode = _DFU_PROTOCOL_DFU
-  
-        break
+  intf = dfu_interfaces[0][0]
+  interface = intf.bInterfaceNumber
+  if (intf.bInterfaceProtocol == _DFU_PROTOCOL_DFU):
+    dfu_mode = _DFU_PROTOCOL_DFU
 
   if args.interface:
     interface = args.interface
   
   altsetting = args.match_iface_alt_index
-  return dev, dfu_mode, bitWillDetach, interface, altsetting, transfer_size
+  return dev, dfu_mode, bmAttributes, interface, altsetting, transfer_size
 
-def main() -> int:
+def _log_dfu_device(
+  dev: usb.core.Device, dfu_mode: int, interface: int, altsetting: int, transfer_size: int
+) -> None:
+  logger.debug("get_dfu_device:")
+  logger.debug(" vid:pid = %04x:%04x", dev.idVendor, dev.idProduct)
+  logger.debug(" dfu_mode = %d", dfu_mode)
+  logger.debug(" selected interface = %d", interface)
+  logger.debug(" selected altsetting = %d", altsetting)
+  logger.debug(" selected transfer size = %d", transfer_size)
+
+def main(args: argparse.Namespace) -> int:
   command = CMD_NONE
+  colorama.just_fix_windows_console()
 
   if args.device:
     vidpid = args.device.split(":")
@@ -672,8 +809,7 @@ def main() -> int:
     print("No command specified")
     return 0
 
-  if args.verbose:
-    print(f"command = {command}")
+  logger.debug("command = %d", command)
 
   dfu_device = None
 
@@ -684,30 +820,27 @@ def main() -> int:
       list_devices(vid=vid, pid=pid)
       return error
 
-    dfu_device, dfu_mode, bitWillDetach, interface, altsetting, transfer_size = get_dfu_device(vid=vid, pid=pid)
+    dfu_device, dfu_mode, bmAttributes, interface, altsetting, transfer_size = get_dfu_device(args, vid=vid, pid=pid)
 
     if dfu_device == None:
       return 1
 
-    if args.verbose:
-      print(f"get_dfu_device:")
-      print(f" vid:pid = {dfu_device.idVendor:04x}:{dfu_device.idProduct:04x}")
-      print(f" dfu_mode = {dfu_mode}")
-      print(f" selected interface = {interface}")
-      print(f" selected altsetting = {altsetting}")
-      print(f" selected transfer size = {transfer_size}")
+    _log_dfu_device(dfu_device, dfu_mode, interface, altsetting, transfer_size)
 
     if command == CMD_DETACH:
       dfu_claim_interface(dfu_device, interface, altsetting)
-      dfu_device.set_interface_altsetting(interface, altsetting)
-      error = detch(dfu_device, interface)
+      error = detch(dfu_device, interface, args.detach_delay)
       dfu_release_interface(dfu_device)
       return error
 
+    # set while dfu_device is claimed on interface/altsetting, so a device
+    # that advertises run-time mode but answers as DFU is claimed once
+    claimed = False
+
     if dfu_mode != _DFU_PROTOCOL_DFU:
       print(f"Device is running in run-time mode")
       dfu_claim_interface(dfu_device, interface, altsetting)
-      dfu_device.set_interface_altsetting(interface, altsetting)
+      claimed = True
 
       status = dfu_get_state(dfu_device, interface)
       sleep(status.bwPollTimeout/1000)
@@ -720,31 +853,26 @@ def main() -> int:
 
       if (status.bState == _DFU_STATE_APP_IDLE or status.bState == _DFU_STATE_APP_DETACH):
         print("Device is really in run-time mode, send DFU detach request")
-        error = detch(dfu_device, interface)
+        error = detch(dfu_device, interface, args.detach_delay)
         if error != 0:
           return 1
 
         dfu_release_interface(dfu_device)
-        dfu_device, dfu_mode, bitWillDetach, interface, altsetting, transfer_size = get_dfu_device(vid=vid, pid=pid)
+        claimed = False
+        dfu_device, dfu_mode, bmAttributes, interface, altsetting, transfer_size = get_dfu_device(args, vid=vid, pid=pid)
 
         if dfu_device == None:
           return 1
 
-        if args.verbose:
-          print(f"get_dfu_device:")
-          print(f" vid:pid = {dfu_device.idVendor:04x}:{dfu_device.idProduct:04x}")
-          print(f" dfu_mode = {dfu_mode}")
-          print(f" selected interface = {interface}")
-          print(f" selected altsetting = {altsetting}")
-          print(f" selected transfer size = {transfer_size}")
+        _log_dfu_device(dfu_device, dfu_mode, interface, altsetting, transfer_size)
 
         if dfu_mode != _DFU_PROTOCOL_DFU:
           print(f"Failed! device is still in run-time mode")
           return 1
 
     print(f"Device is really in dfu mode")
-    dfu_claim_interface(dfu_device, interface, altsetting)
-    dfu_device.set_interface_altsetting(interface, altsetting)
+    if not claimed:
+      dfu_claim_interface(dfu_device, interface, altsetting)
     
     if transfer_size > _MAX_TRANSFER_SIZE:
       print(f"Failed! transfer size > " + str(_MAX_TRANSFER_SIZE))
@@ -760,7 +888,8 @@ def main() -> int:
         dev=dfu_device,
         filename=args.download_file,
         interface=interface,
-        transferSize=transfer_size
+        transferSize=transfer_size,
+        attributes=bmAttributes
       )
       stop = timeit.default_timer()
       print(f"The elapsed time = {stop - start:f} sec")
@@ -771,13 +900,14 @@ def main() -> int:
         dev=dfu_device,
         filename=args.upload_file,
         interface=interface,
-        transferSize=transfer_size
+        transferSize=transfer_size,
+        upload_size=args.upload_size
       )
       stop = timeit.default_timer()
       print(f"The elapsed time = {stop - start:f} sec")
 
     if args.final_detach and error == 0:
-      detch(dfu_device, interface)
+      detch(dfu_device, interface, args.detach_delay)
       print(f"delay {args.detach_delay} sec")
       sleep(args.detach_delay)
 
@@ -785,7 +915,7 @@ def main() -> int:
       # detach-attach sequence when it receives a DFU_DETACH request. 
       # The host must not issue a USB Reset. (bitWillDetach)
       # 0 = no; 1 = yes
-      if bitWillDetach is False :
+      if not (bmAttributes & _DFU_WILL_DETACH) :
         print("issue usb reset")
         dfu_device.reset()
 
@@ -796,6 +926,7 @@ def main() -> int:
     ValueError,
     FileNotFoundError,
     IsADirectoryError,
+    TimeoutError,
     usb.core.USBError,
   ) as err:
     if dfu_device != None:
@@ -921,21 +1052,15 @@ if __name__ == '__main__':
   )
 
   args = parser.parse_args()
-  logging.basicConfig(level=logging.INFO)
-
-  if args.verbose:
-    print(f'version = {args.version}')
-    print(f'verbose = {args.verbose}')
-    print(f'list = {args.list}')
-    print(f'download_file = {args.download_file}')
-    print(f'upload_file = {args.upload_file}')
-    print(f'device = {args.device}')
-    print(f'interface = {args.interface}')
-    print(f'match_iface_alt_index = {args.match_iface_alt_index}')
-    print(f'transfer_size = {args.transfer_size}')
-    print(f'upload_size = {args.upload_size}')
-    print(f'detach = {args.detach}')
-    print(f'detach_delay = {args.detach_delay}')
-    print(f'final_detach = {args.final_detach}')
-
-  sys.exit(main())
+  # -v shows the debug log, pyusb's own "usb" logger stays quiet
+  # unless PYUSB_DEBUG is set
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+  for name, value in vars(args).items():
+    logger.debug("%s = %s", name, value)
+
+  # raise the Windows timer resolution once for the whole run
+  _timer_resolution_begin()
+  try:
+    sys.exit(main(args))
+  finally:
+    _timer_resolution_end()